@@ -1,5 +1,11 @@
 import os
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import pandas as pd
@@ -30,6 +36,29 @@ langfuse = Langfuse(
 EXCEL_FILE = "Consumer Order History 1  .xlsx"
 BACKEND_URL = "http://localhost:5000/api"
 
+# Request coalescing: duplicate chat requests (voice retries, double-tapped send)
+# share the result of the first in-flight call instead of making their own.
+# Finished results are kept briefly so late retries also reuse them, and
+# placed orders are remembered much longer so a retry can never re-save one.
+# Message fingerprints are only used within a session, so requests with
+# neither a request ID nor a session ID are never coalesced.
+COALESCE_TTL_SECONDS = 10
+ORDER_RECORD_TTL_SECONDS = 24 * 60 * 60
+_inflight_chats = {}
+# Entries share one TTL per cache, so insertion order is expiry order
+_recent_chats = OrderedDict()
+_completed_orders = OrderedDict()
+# Chats now run in parallel threads; serialize the Excel read-modify-write
+_excel_lock = threading.Lock()
+coalesce_stats = {
+    "leaders": 0,
+    "coalesced": 0,
+    "replayed": 0,
+    "uncoalesced": 0,
+    "orders_saved": 0,
+    "order_save_failures": 0,
+}
+
 # System Prompt
 SYSTEM_PROMPT = """
 You are an AI Pharmacy Assistant designed only for medicine-related conversations.
@@ -87,16 +116,99 @@ async def get_traces():
         } for i in range(10)
     ]
 
+@app.get("/coalesce-stats")
+async def get_coalesce_stats():
+    return {**coalesce_stats, "in_flight": len(_inflight_chats)}
+
+def chat_request_key(request, data):
+    # A client request ID is unique on its own. Without one, a message
+    # fingerprint is only safe inside a session, since different customers
+    # often send the same short message; otherwise skip coalescing.
+    session_id = request.headers.get("x-session-id") or data.get("session_id")
+    request_id = request.headers.get("x-request-id") or data.get("request_id")
+    if not request_id and not session_id:
+        return None
+    fingerprint = json.dumps({
+        "request_id": request_id,
+        "message": data.get("message"),
+        "history": data.get("history", []),
+    }, sort_keys=True, default=str)
+    digest = hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+    return f"{session_id or ''}:{digest}"
+
 @app.post("/chat")
 async def chat(request: Request):
     data = await request.json()
+    key = chat_request_key(request, data)
+    if key is None:
+        coalesce_stats["uncoalesced"] += 1
+        response_data, order_saved = await run_in_threadpool(process_chat, data)
+        record_order_stats(response_data, order_saved)
+        return response_data
+
+    now = time.monotonic()
+    for cache in (_recent_chats, _completed_orders):
+        while cache and next(iter(cache.values()))[0] <= now:
+            cache.popitem(last=False)
+
+    # A retry of a request that already placed an order gets the original
+    # reply back instead of running the LLM and save_order a second time.
+    if key in _completed_orders:
+        coalesce_stats["replayed"] += 1
+        return _completed_orders[key][1]
+    if key in _recent_chats:
+        coalesce_stats["replayed"] += 1
+        return _recent_chats[key][1]
+
+    task = _inflight_chats.get(key)
+    if task is not None:
+        coalesce_stats["coalesced"] += 1
+    else:
+        coalesce_stats["leaders"] += 1
+        # The OpenAI and Excel calls block, so run them off the event loop
+        # to let duplicates arrive and attach to this task meanwhile.
+        task = asyncio.ensure_future(run_in_threadpool(process_chat, data))
+        _inflight_chats[key] = task
+        task.add_done_callback(lambda t: finish_chat(key, t))
+
+    # Shield so a disconnecting client cannot cancel the shared call
+    response_data, _ = await asyncio.shield(task)
+    return response_data
+
+def finish_chat(key, task):
+    # Runs on the event loop, so the shared caches and counters need no lock
+    _inflight_chats.pop(key, None)
+    if task.cancelled() or task.exception() is not None:
+        return
+    response_data, order_saved = task.result()
+    record_order_stats(response_data, order_saved)
+    now = time.monotonic()
+    remember(_recent_chats, key, now + COALESCE_TTL_SECONDS, response_data)
+    # Failed saves only get the short window so a later retry can place the order
+    if response_data.get("action") == "order" and order_saved:
+        remember(_completed_orders, key, now + ORDER_RECORD_TTL_SECONDS, response_data)
+
+def remember(cache, key, expires, response_data):
+    cache[key] = (expires, response_data)
+    cache.move_to_end(key)
+
+def record_order_stats(response_data, order_saved):
+    if response_data.get("action") != "order":
+        return
+    if order_saved:
+        coalesce_stats["orders_saved"] += 1
+    else:
+        coalesce_stats["order_save_failures"] += 1
+
+def process_chat(data):
     user_input = data.get("message")
     history = data.get("history", [])
     
     # Logic to identify refills (Predictive Intelligence)
     history_context = ""
     try:
-        df = pd.read_excel(EXCEL_FILE)
+        with _excel_lock:
+            df = pd.read_excel(EXCEL_FILE)
         # Simple match by name if provided in history or current message
         if user_input:
             match = df[df['Name'].str.contains(user_input, na=False, case=False)]
@@ -122,20 +234,29 @@ async def chat(request: Request):
     if response_data.get("action") == "refill":
         print("Proactive Refill Event Triggered")
         
-    # If the action is "order", we save it to Excel and DB
+    # If the action is "order", we save it to Excel and DB. Duplicates with
+    # a session ID are answered from _completed_orders and never get here.
+    order_saved = False
     if response_data.get("action") == "order":
-        save_order(response_data.get("order_details"))
+        order_saved = save_order(response_data.get("order_details"))
         
-    langfuse.generation(
-        name="pharmacy-chat-gen",
-        input=user_input,
-        output=response_data,
-        metadata={"history_context": history_context}
-    )
+    # Tracing must not fail the request once the order may already be saved
+    try:
+        langfuse.generation(
+            name="pharmacy-chat-gen",
+            input=user_input,
+            output=response_data,
+            metadata={"history_context": history_context}
+        )
+    except Exception as e:
+        print("Langfuse Trace Error:", e)
     
-    return response_data
+    return response_data, order_saved
 
 def save_order(details):
+    # Returns True only when both the DB and the Excel save succeed
+    saved = True
+
     # Save to Database
     try:
         res = requests.post(f"{BACKEND_URL}/orders", json={
@@ -145,27 +266,37 @@ def save_order(details):
             "items": details.get("items", [])
         })
         print("DB Save Status:", res.status_code)
+        if not res.ok:
+            saved = False
     except Exception as e:
         print("DB Save Error:", e)
+        saved = False
 
     # Save to Excel
     try:
-        df = pd.read_excel(EXCEL_FILE)
-        new_row = {
-            'Patient ID': f"PAT{len(df)+1:03d}",
-            'Patient Age': details.get("customer", {}).get("age"),
-            'Name': details.get("customer", {}).get("name"),
-            'Mobile number': details.get("customer", {}).get("mobile"),
-            'Medicine Name': ", ".join([i['name'] for i in details.get("medicines", [])]),
-            'Quantity': sum([i['quantity'] for i in details.get("medicines", [])]),
-            'Date of Purchase': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'Total Price': details.get("total_price")
-        }
-        df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-        df.to_excel(EXCEL_FILE, index=False)
+        with _excel_lock:
+            save_order_to_excel(details)
         print("Excel Save Success")
     except Exception as e:
         print("Excel Save Error:", e)
+        saved = False
+
+    return saved
+
+def save_order_to_excel(details):
+    df = pd.read_excel(EXCEL_FILE)
+    new_row = {
+        'Patient ID': f"PAT{len(df)+1:03d}",
+        'Patient Age': details.get("customer", {}).get("age"),
+        'Name': details.get("customer", {}).get("name"),
+        'Mobile number': details.get("customer", {}).get("mobile"),
+        'Medicine Name': ", ".join([i['name'] for i in details.get("medicines", [])]),
+        'Quantity': sum([i['quantity'] for i in details.get("medicines", [])]),
+        'Date of Purchase': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'Total Price': details.get("total_price")
+    }
+    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
+    df.to_excel(EXCEL_FILE, index=False)
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,7 +1,11 @@
 import requests
 import json
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 URL = "http://localhost:8000/chat"
+STATS_URL = "http://localhost:8000/coalesce-stats"
 
 def test_chat():
     payload = {"message": "What is the stock of Vitamin C?"}
@@ -12,5 +16,53 @@ def test_chat():
     except Exception as e:
         print(f"Error: {e}")
 
+def post_all(payloads):
+    with ThreadPoolExecutor(max_workers=len(payloads)) as pool:
+        return list(pool.map(lambda p: requests.post(URL, json=p).json(), payloads))
+
+def stats_delta(before):
+    after = requests.get(STATS_URL).json()
+    return {k: after[k] - before[k] for k in before if k != "in_flight"}
+
+def test_coalescing():
+    message = "Do you have Paracetamol?"
+    try:
+        # Three concurrent copies from one session should share one LLM call
+        before = requests.get(STATS_URL).json()
+        session = f"verify-{uuid.uuid4()}"
+        replies = post_all([{"message": message, "session_id": session}] * 3)
+        delta = stats_delta(before)
+        print(f"Duplicate stats: {delta}")
+        assert delta["leaders"] == 1, "duplicates should start one call"
+        assert delta["coalesced"] + delta["replayed"] == 2, "duplicates should be merged"
+        assert all(r == replies[0] for r in replies), "duplicates should get the same reply"
+
+        # The same message from two different sessions must not be merged
+        before = requests.get(STATS_URL).json()
+        post_all([
+            {"message": message, "session_id": f"verify-{uuid.uuid4()}"},
+            {"message": message, "session_id": f"verify-{uuid.uuid4()}"},
+        ])
+        delta = stats_delta(before)
+        print(f"Cross-session stats: {delta}")
+        assert delta["leaders"] == 2, "different sessions should not be merged"
+        assert delta["coalesced"] + delta["replayed"] == 0, "different sessions should not be merged"
+
+        # Requests without a request or session ID are never coalesced
+        before = requests.get(STATS_URL).json()
+        post_all([{"message": message}] * 2)
+        delta = stats_delta(before)
+        print(f"No-session stats: {delta}")
+        assert delta["uncoalesced"] == 2, "requests without an ID should run separately"
+
+        print("Coalescing checks passed")
+    except AssertionError as e:
+        print(f"Coalescing check failed: {e}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
 if __name__ == "__main__":
     test_chat()
+    test_coalescing()
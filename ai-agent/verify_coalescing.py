@@ -0,0 +1,109 @@
+"""Offline check of /chat request coalescing.
+
+Replaces the OpenAI, Langfuse and save_order calls with stubs and fires
+concurrent requests through FastAPI's TestClient. Run directly or with pytest.
+"""
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+
+import main
+
+ORDER_REPLY = {
+    "reply": "Order placed",
+    "action": "order",
+    "order_details": {"medicines": [], "total_price": 0, "customer": {}},
+}
+
+class FakeCompletions:
+    def __init__(self):
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def create(self, **kwargs):
+        with self.lock:
+            self.calls += 1
+        time.sleep(0.3)  # long enough for duplicates to arrive in flight
+        content = json.dumps(ORDER_REPLY)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+class FakeSaveOrder:
+    def __init__(self, result=True):
+        self.result = result
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, details):
+        with self.lock:
+            self.calls += 1
+        return self.result
+
+def setup(save_result=True):
+    main._inflight_chats.clear()
+    main._recent_chats.clear()
+    main._completed_orders.clear()
+    for k in main.coalesce_stats:
+        main.coalesce_stats[k] = 0
+    completions = FakeCompletions()
+    save_order = FakeSaveOrder(save_result)
+    main.openai = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    main.langfuse = SimpleNamespace(generation=lambda **kwargs: None)
+    main.save_order = save_order
+    return completions, save_order
+
+def post_all(client, payloads):
+    with ThreadPoolExecutor(max_workers=len(payloads)) as pool:
+        return list(pool.map(lambda p: client.post("/chat", json=p).json(), payloads))
+
+def test_duplicates_share_one_call_and_one_save():
+    completions, save_order = setup()
+    with TestClient(main.app) as client:
+        replies = post_all(client, [{"message": "yes", "request_id": "r1"}] * 3)
+        assert completions.calls == 1
+        assert save_order.calls == 1
+        assert all(r == ORDER_REPLY for r in replies)
+
+        # A late retry after the short window is replayed from the order record
+        main._recent_chats.clear()
+        client.post("/chat", json={"message": "yes", "request_id": "r1"})
+        assert completions.calls == 1
+        assert save_order.calls == 1
+        assert main.coalesce_stats["orders_saved"] == 1
+
+def test_sessions_are_not_merged():
+    completions, save_order = setup()
+    with TestClient(main.app) as client:
+        post_all(client, [
+            {"message": "yes", "session_id": "a"},
+            {"message": "yes", "session_id": "b"},
+        ])
+        assert completions.calls == 2
+        assert save_order.calls == 2
+
+        # Without a request or session ID nothing is coalesced
+        post_all(client, [{"message": "yes"}] * 2)
+        assert completions.calls == 4
+        assert main.coalesce_stats["uncoalesced"] == 2
+
+def test_failed_save_can_be_retried():
+    completions, save_order = setup(save_result=False)
+    with TestClient(main.app) as client:
+        client.post("/chat", json={"message": "yes", "request_id": "r2"})
+        assert main.coalesce_stats["order_save_failures"] == 1
+        assert not main._completed_orders
+
+        # Once the short window passes, a retry places the order again
+        main._recent_chats.clear()
+        client.post("/chat", json={"message": "yes", "request_id": "r2"})
+        assert save_order.calls == 2
+
+if __name__ == "__main__":
+    # An AssertionError propagates and exits non-zero
+    test_duplicates_share_one_call_and_one_save()
+    test_sessions_are_not_merged()
+    test_failed_save_can_be_retried()
+    print("Coalescing checks passed")